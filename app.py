@@ -1,13 +1,29 @@
 import streamlit as st
-import openai
 import json
+try:
+    import orjson # Opcional: parseo/serialización JSON más rápidos
+except ImportError:
+    orjson = None
 import pandas as pd
 import numpy as np # Para dtypes numéricos
+from pandas.api.types import union_categoricals
 import re # Para un fallback si el LLM falla
 import os
 import io # Para manejar bytes en memoria para la descarga
-import pyreadstat # Para guardar archivos .sav
 import tempfile 
+import functools
+import hashlib
+import importlib.util
+import sqlite3
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Copy-on-Write: las copias y renombrados comparten memoria hasta que una columna se modifica
+pd.options.mode.copy_on_write = True
 
 # --- Configuración de la Página de Streamlit ---
 st.set_page_config(layout="wide", page_title="Procesador de Datos para SPSS", initial_sidebar_state="expanded")
@@ -27,13 +43,43 @@ Sube un archivo CSV o Excel, elige las operaciones y descarga los resultados en
 MAX_CATEGORIAS_PARA_LLM = 15 # Aumentado ligeramente para dar más flexibilidad
 SPSS_VAR_NAME_MAX_LEN = 64
 MODELO_LLM_PRINCIPAL = "gpt-4.1-mini" # Modelo especificado por el usuario
+MODELOS_CODIFICACION = ("gpt-4.1-mini", "gpt-4.1-nano", "gpt-4o-mini", "gpt-4.1") # Opciones para la codificación categórica
+MAX_LLM_CONCURRENTES = 10 # Peticiones simultáneas a OpenAI (respeta los límites de tasa)
+LLM_CACHE_PATH = ".llm_cache.sqlite3" # Caché en disco de respuestas del LLM
+LLM_COLUMNAS_POR_PETICION = 50 # Columnas por petición al simplificar nombres o generar etiquetas
+LOTE_INTERVALO_PANEL = 5 # Segundos entre ejecuciones del panel de lotes de la Batch API (fragmento, no bloquea el script)
+LOTE_ESPERA_MAXIMA = 300 # Máximo de segundos entre dos consultas automáticas a un mismo lote
+LOG_MAX_MENSAJES = 2000 # Mensajes del log que se conservan en la sesión
+LLM_PROMPT_CONCISO = bool(os.environ.get("LIMPIEZA_TERSE")) # Omite los ejemplos few-shot de los prompts de nombres y etiquetas
+
+# --- Expresiones regulares precompiladas ---
+# Cada signo de puntuación se sustituye por '_' y cada racha de espacios por un único '_'
+_RE_PUNTUACION_O_ESPACIOS = re.compile(r'[.:\-/]|\s+')
+_RE_NO_PALABRA = re.compile(r'[^\w_]')
+# Equivalente a _RE_NO_PALABRA para texto ASCII: str.translate borra los caracteres con una tabla en C
+_TABLA_NO_PALABRA_ASCII = str.maketrans({c: None for c in map(chr, range(128)) if not (c.isalnum() or c == '_')})
+_RE_AGREE_DISAGREE = re.compile(r':Please say whether you AGREE or DISAGREE with the following statements\.', re.IGNORECASE)
+_RE_PLEASE_TELL_US = re.compile(r'Please tell us.*', re.IGNORECASE)
+_RE_OPTIONAL = re.compile(r'\(optional\)', re.IGNORECASE)
+_RE_SIGNOS = re.compile(r'[¿?.:!]')
 
 # --- Función de Sanitización ---
+def _is_valid_spss_varname(name_str):
+    # Nombres ya válidos (ASCII, empiezan por letra, solo letras/dígitos/_ y longitud permitida) quedan igual tras sanitizar
+    return (isinstance(name_str, str) and name_str.isascii() and 0 < len(name_str) <= SPSS_VAR_NAME_MAX_LEN
+            and name_str[0].isalpha() and name_str.replace('_', 'a').isalnum())
+
+# Función pura: se memoriza para no repetir los regex con nombres ya vistos (mismas columnas en cada rerun)
+@functools.lru_cache(maxsize=4096, typed=True)
 def sanitize_spss_varname(name_str):
+    if _is_valid_spss_varname(name_str):
+        return name_str
     name_str = str(name_str)
-    name_str = re.sub(r'[.:\-/]', '_', name_str) 
-    name_str = re.sub(r'\s+', '_', name_str)     
-    name_str = re.sub(r'[^\w_]', '', name_str)  
+    name_str = _RE_PUNTUACION_O_ESPACIOS.sub('_', name_str)
+    if name_str.isascii():
+        name_str = name_str.translate(_TABLA_NO_PALABRA_ASCII)
+    else:
+        name_str = _RE_NO_PALABRA.sub('', name_str)
     if not name_str or not name_str[0].isalpha():
         name_str = "V_" + name_str 
     name_str = name_str[:SPSS_VAR_NAME_MAX_LEN]
@@ -41,18 +87,234 @@ def sanitize_spss_varname(name_str):
         return "UnnamedVar"
     return name_str
 
+def make_unique_names(nombres_propuestos):
+    # Añade el sufijo _N a los nombres repetidos. El contador por nombre base evita
+    # volver a probar desde _1 en cada colisión (lineal en lugar de cuadrático).
+    contador = defaultdict(int)
+    vistos = set()
+    nombres_unicos = []
+    for nombre in nombres_propuestos:
+        nombre_unico = nombre
+        while nombre_unico in vistos:
+            contador[nombre] += 1
+            sufijo = str(contador[nombre])
+            nombre_unico = f"{nombre[:SPSS_VAR_NAME_MAX_LEN - (len(sufijo)+1)]}_{sufijo}"
+        vistos.add(nombre_unico)
+        nombres_unicos.append(nombre_unico)
+    return nombres_unicos
+
+# --- JSON (orjson si está instalado, json estándar si no) ---
+def json_loads(texto):
+    # orjson.JSONDecodeError hereda de json.JSONDecodeError, así que los except existentes siguen valiendo
+    if orjson is not None:
+        return orjson.loads(texto)
+    return json.loads(texto)
+
+def json_dumps(obj, sort_keys=False):
+    if orjson is not None:
+        # OPT_NON_STR_KEYS: como json estándar, admite claves no str (int, fechas) en lugar de lanzar TypeError
+        opciones = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, option=opciones).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, sort_keys=sort_keys)
+
+# --- Concurrencia para llamadas LLM ---
+def _crear_executor_llm(max_workers=MAX_LLM_CONCURRENTES):
+    # Los hilos heredan el contexto de Streamlit para poder usar st.error/st.warning
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx()))
+
+@st.cache_resource
+def _get_llm_semaforo(limite=MAX_LLM_CONCURRENTES):
+    # Límite global de peticiones en vuelo: la codificación en segundo plano y los lotes de nombres/etiquetas
+    # usan pools distintos que, sumados, podrían superar MAX_LLM_CONCURRENTES
+    return threading.BoundedSemaphore(limite)
+
+# --- Caché persistente de respuestas LLM ---
+@st.cache_resource
+def _get_llm_cache(path=LLM_CACHE_PATH):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # WAL + synchronous=NORMAL: cada inserción no fuerza un fsync del archivo completo
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS respuestas (clave TEXT PRIMARY KEY, respuesta TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS codificaciones (clave TEXT PRIMARY KEY, sugerencia TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS nombres (clave TEXT PRIMARY KEY, nombre TEXT NOT NULL)")
+    conn.commit()
+    return conn, threading.Lock()
+
+def clear_llm_cache():
+    conn, lock = _get_llm_cache()
+    with lock, conn:
+        conn.execute("DELETE FROM respuestas")
+        conn.execute("DELETE FROM codificaciones")
+        conn.execute("DELETE FROM nombres")
+
+# Codificaciones por conjunto de categorías: se reutilizan entre sesiones y archivos aunque la columna
+# aparezca en otro lote (la caché de respuestas depende del prompt completo)
+# La clave ignora mayúsculas y espacios ("Muy de acuerdo" == "muy de acuerdo "), salvo que eso junte
+# dos categorías del mismo conjunto; en ese caso se usan las categorías exactas.
+# Las claves de las cachés son pares (modelo, frozenset de categorías): cambiar de modelo vuelve a consultar.
+def _normalizar_categoria(categoria):
+    return str(categoria).strip().casefold()
+
+def _clave_codificacion(modelo, categorias):
+    normalizadas = {_normalizar_categoria(c) for c in categorias}
+    partes_clave = [modelo, "normalizada", sorted(normalizadas)] if len(normalizadas) == len(categorias) else [modelo, "exacta", sorted(categorias)]
+    return hashlib.sha256(json.dumps(partes_clave, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def _adapt_stored_encoding(sugerencia, categorias):
+    # El mapeo guardado puede venir de un conjunto escrito distinto: se reexpresa con las categorías actuales
+    mapeo_guardado = sugerencia.get("mapping_dict")
+    if not isinstance(mapeo_guardado, dict):
+        return sugerencia
+    por_normalizada = {_normalizar_categoria(k): v for k, v in mapeo_guardado.items()}
+    if len(por_normalizada) != len(mapeo_guardado):
+        return sugerencia # Guardado con clave exacta: las categorías coinciden tal cual
+    mapeo = {c: por_normalizada[_normalizar_categoria(c)] for c in categorias if _normalizar_categoria(c) in por_normalizada}
+    return {**sugerencia, "mapping_dict": mapeo or None}
+
+def load_stored_encodings(claves):
+    conn, lock = _get_llm_cache()
+    encontradas = {}
+    with lock:
+        for modelo, categorias in claves:
+            fila = conn.execute("SELECT sugerencia FROM codificaciones WHERE clave = ?", (_clave_codificacion(modelo, categorias),)).fetchone()
+            if fila:
+                encontradas[(modelo, categorias)] = _adapt_stored_encoding(json_loads(fila[0]), categorias)
+    return encontradas
+
+def store_encodings(sugerencias_por_clave):
+    conn, lock = _get_llm_cache()
+    with lock, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO codificaciones (clave, sugerencia) VALUES (?, ?)",
+            [(_clave_codificacion(modelo, categorias), json_dumps(sugerencia)) for (modelo, categorias), sugerencia in sugerencias_por_clave.items()]
+        )
+
+# Nombres simplificados por columna original: un archivo que comparte solo parte de sus columnas con otro
+# reutiliza esos nombres (la caché de respuestas solo acierta si el lote completo es idéntico)
+def _clave_nombre(model, nombre_original):
+    return hashlib.sha256(json.dumps([model, nombre_original], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def load_stored_names(nombres_originales, model):
+    conn, lock = _get_llm_cache()
+    encontrados = {}
+    with lock:
+        for nombre in nombres_originales:
+            fila = conn.execute("SELECT nombre FROM nombres WHERE clave = ?", (_clave_nombre(model, nombre),)).fetchone()
+            if fila:
+                encontrados[nombre] = fila[0]
+    return encontrados
+
+def store_names(simplificados, model):
+    conn, lock = _get_llm_cache()
+    with lock, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO nombres (clave, nombre) VALUES (?, ?)",
+            [(_clave_nombre(model, original), simplificado) for original, simplificado in simplificados.items()]
+        )
+
+def cached_chat(client, model, system_content, user_content, response_format=None):
+    # La clave cubre exactamente lo que se envía al modelo; solo se guardan respuestas JSON válidas
+    partes_clave = [model, system_content, user_content] if response_format is None else [model, system_content, user_content, response_format]
+    clave = hashlib.sha256(json.dumps(partes_clave, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+    conn, lock = _get_llm_cache()
+    with lock:
+        fila = conn.execute("SELECT respuesta FROM respuestas WHERE clave = ?", (clave,)).fetchone()
+    if fila:
+        return fila[0]
+
+    # La respuesta se recibe en streaming para mostrar el avance mientras el modelo genera el JSON
+    partes = []
+    caracteres_recibidos = 0
+    progreso = st.empty()
+    with _get_llm_semaforo():
+        response_stream = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_content},
+                {"role": "user", "content": user_content}
+            ],
+            response_format=response_format or {"type": "json_object"},
+            stream=True
+        )
+        for i, chunk in enumerate(response_stream):
+            if chunk.choices and chunk.choices[0].delta.content:
+                partes.append(chunk.choices[0].delta.content)
+                caracteres_recibidos += len(partes[-1])
+            if i % 20 == 0:
+                progreso.caption(f"Recibiendo respuesta del LLM... {caracteres_recibidos} caracteres")
+    progreso.empty()
+    llm_response_json = "".join(partes)
+    try:
+        json_loads(llm_response_json)
+    except (json.JSONDecodeError, TypeError):
+        return llm_response_json
+    with lock, conn:
+        conn.execute("INSERT OR REPLACE INTO respuestas (clave, respuesta) VALUES (?, ?)", (clave, llm_response_json))
+    return llm_response_json
+
+# --- Aplicación vectorizada de la codificación ---
+def as_categorical(serie):
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        return serie
+    return serie.astype('category')
+
+def normalize_categories(categorias):
+    # Normalización de texto (str, strip, '' -> 'nan') aplicada a las k categorías, no a las n filas
+    categorias = pd.Index(categorias).astype(str).str.strip()
+    return categorias.where(categorias != '', 'nan')
+
+def map_categories_to_codes(serie, mapeo_texto_a_numero):
+    # La búsqueda en el diccionario se hace una vez por categoría y luego se indexa por código (en C),
+    # en lugar de una búsqueda por fila. El último elemento cubre los NaN (código -1), que se tratan como 'nan'.
+    # El resultado se construye directamente como entero nullable (valores + máscara de faltantes), sin pasar por float.
+    serie = as_categorical(serie)
+    claves = normalize_categories(serie.cat.categories).tolist() + ['nan']
+    valores = np.array([mapeo_texto_a_numero.get(c, 0) for c in claves], dtype=np.int64)
+    # Los códigos de encuesta son enteros pequeños: se usa el entero más estrecho que los contiene (Int8/Int16/...)
+    for tipo_entero in (np.int8, np.int16, np.int32):
+        if np.iinfo(tipo_entero).min <= valores.min() and valores.max() <= np.iinfo(tipo_entero).max:
+            valores = valores.astype(tipo_entero)
+            break
+    faltantes = np.array([c not in mapeo_texto_a_numero for c in claves], dtype=bool)
+    codigos = serie.cat.codes.to_numpy()
+    return pd.Series(pd.arrays.IntegerArray(valores[codigos], faltantes[codigos]), index=serie.index)
+
+def classify_categories_locally(categorias):
+    # Si todas las categorías son números enteros (ej. "1".."5") se codifican con su propio valor
+    # sin consultar al LLM. Cualquier otra cosa (texto, decimales, 'nan') se deja al LLM.
+    mapeo = {}
+    for categoria in categorias:
+        try:
+            valor = float(categoria)
+        except ValueError:
+            return None
+        if not valor.is_integer():
+            return None
+        mapeo[categoria] = int(valor)
+    return {"needs_encoding": True, "mapping_dict": mapeo}
+
 # --- Funciones LLM ---
 
-def simplify_survey_column_names_llm(column_names_list, client, model=MODELO_LLM_PRINCIPAL):
-    if not client:
-        st.error("Error: El cliente de OpenAI no está inicializado.")
-        return None
-    if not column_names_list:
-        st.warning("La lista de nombres de columnas está vacía.")
-        return {}
-    column_names_for_prompt = "\n".join([f"- \"{name}\"" for name in column_names_list])
-    prompt = f"""
-Eres un asistente experto en preparar datos de encuestas para análisis estadístico, especialmente para SPSS.
+def run_llm_chunks(chunk_fn, lotes, client, model):
+    # Cada lote es una petición independiente y más corta; se envían en paralelo y se devuelven en orden
+    if len(lotes) == 1:
+        return [chunk_fn(lotes[0], client, model)]
+    resultados = [None] * len(lotes)
+    progreso = st.empty()
+    with _crear_executor_llm(max_workers=min(MAX_LLM_CONCURRENTES, len(lotes))) as executor:
+        futuros = {executor.submit(chunk_fn, lote, client, model): i for i, lote in enumerate(lotes)}
+        # Se informa del avance a medida que terminan los lotes, en el orden en que terminan
+        for completados, futuro in enumerate(as_completed(futuros), start=1):
+            resultados[futuros[futuro]] = futuro.result()
+            progreso.caption(f"Lotes LLM completados: {completados}/{len(lotes)}")
+    progreso.empty()
+    return resultados
+
+# Las instrucciones y los ejemplos son fijos y van en el mensaje de sistema; el mensaje de usuario solo lleva
+# la lista de columnas (prefijo idéntico entre peticiones y ejemplos omitibles con LIMPIEZA_TERSE)
+_SISTEMA_NOMBRES = f"""
+Eres un experto en crear nombres de variable cortos y válidos (máx {SPSS_VAR_NAME_MAX_LEN} caracteres) para SPSS a partir de preguntas de encuestas. Devuelves solo JSON.
 Te proporcionaré una lista de nombres de columnas que a menudo son preguntas completas de una encuesta.
 Tu tarea es, para CADA nombre de columna original, generar un NOMBRE DE VARIABLE CORTO, CLARO y VÁLIDO para SPSS.
 
@@ -67,6 +329,15 @@ Consideraciones para los nuevos NOMBRES DE VARIABLE:
 Devuelve tu respuesta ÚNICAMENTE como un objeto JSON que mapee cada nombre de columna ORIGINAL a su nuevo NOMBRE DE VARIABLE SIMPLIFICADO.
 Asegúrate de que CADA nombre de columna original de la lista de entrada tenga su correspondiente nombre de variable simplificado en el JSON de salida.
 
+Formato JSON de salida esperado:
+{{
+  "nombre_columna_original_1": "NombreVariable1",
+  "nombre_columna_original_2": "NombreVariable2",
+  ...
+}}
+"""
+
+_EJEMPLOS_NOMBRES = """
 Aquí tienes algunos ejemplos del tipo de transformación deseada:
 - Original: "Corporations and the wealthy have too much influence over government in this country.:Please say whether you AGREE or DISAGREE with the following statements."
   Simplificado: "CorpInfluence"
@@ -78,74 +349,84 @@ Aquí tienes algunos ejemplos del tipo de transformación deseada:
   Simplificado: "CustServSat"
 - Original: "What is your highest level of education completed?"
   Simplificado: "EducationLevel"
-
-Lista de nombres de columnas originales a simplificar:
-{column_names_for_prompt}
-
-Formato JSON de salida esperado:
-{{
-  "nombre_columna_original_1": "NombreVariable1",
-  "nombre_columna_original_2": "NombreVariable2",
-  ...
-}}
 """
+
+def _simplify_names_chunk(column_names_list, client, model):
+    column_names_for_prompt = "\n".join([f"- \"{name}\"" for name in column_names_list])
+    prompt = f"Lista de nombres de columnas originales a simplificar:\n{column_names_for_prompt}"
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": f"Eres un experto en crear nombres de variable cortos y válidos (máx {SPSS_VAR_NAME_MAX_LEN} caracteres) para SPSS a partir de preguntas de encuestas. Devuelves solo JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
+        llm_response_json = cached_chat(
+            client,
+            model,
+            _SISTEMA_NOMBRES if LLM_PROMPT_CONCISO else _SISTEMA_NOMBRES + _EJEMPLOS_NOMBRES,
+            prompt
         )
-        llm_response_json = response.choices[0].message.content
     except Exception as e:
         st.error(f"Error al llamar a la API de OpenAI para simplificar nombres: {e}")
         return None
     try:
-        parsed_response = json.loads(llm_response_json)
+        parsed_response = json_loads(llm_response_json)
         if not isinstance(parsed_response, dict):
             st.error(f"Error: La respuesta del LLM para simplificación no es un diccionario: {parsed_response}")
             return None
         validated_response = {}
         for original, simplified in parsed_response.items():
             validated_response[original] = sanitize_spss_varname(simplified)
-        
-        missing_keys = [name for name in column_names_list if name not in validated_response]
-        if missing_keys:
-            st.warning(f"Advertencia: El LLM no devolvió nombres para las siguientes columnas originales: {missing_keys}")
-            for key in missing_keys:
-                validated_response[key] = basic_column_simplifier(key) 
         return validated_response
     except json.JSONDecodeError as e:
         st.error(f"Error al decodificar JSON de la respuesta del LLM (simplificación): {e}")
         st.text_area("Respuesta recibida del LLM (simplificación):", llm_response_json, height=150)
         return None
 
+def simplify_survey_column_names_llm(column_names_list, client, model=MODELO_LLM_PRINCIPAL):
+    if not client:
+        st.error("Error: El cliente de OpenAI no está inicializado.")
+        return None
+    if not column_names_list:
+        st.warning("La lista de nombres de columnas está vacía.")
+        return {}
+    # Solo se envían al LLM los nombres que no se han simplificado antes con este modelo
+    validated_response = load_stored_names(column_names_list, model)
+    pendientes = list(dict.fromkeys(name for name in column_names_list if name not in validated_response))
+    if pendientes:
+        lotes = [pendientes[i:i + LLM_COLUMNAS_POR_PETICION] for i in range(0, len(pendientes), LLM_COLUMNAS_POR_PETICION)]
+        resultados = run_llm_chunks(_simplify_names_chunk, lotes, client, model)
+        if not validated_response and all(resultado is None for resultado in resultados):
+            return None
+
+        nuevos = {}
+        for resultado in resultados:
+            if resultado:
+                nuevos.update(resultado)
+        validated_response.update(nuevos)
+        # Solo se guardan los nombres devueltos por el LLM (no los del fallback básico)
+        nuevos_pendientes = {name: nuevos[name] for name in pendientes if name in nuevos}
+        if nuevos_pendientes:
+            store_names(nuevos_pendientes, model)
+    missing_keys = [name for name in column_names_list if name not in validated_response]
+    if missing_keys:
+        st.warning(f"Advertencia: El LLM no devolvió nombres para las siguientes columnas originales: {missing_keys}")
+        for key in missing_keys:
+            validated_response[key] = basic_column_simplifier(key) 
+    return validated_response
+
 def basic_column_simplifier(column_name, max_words=3): 
-    name = re.sub(r':Please say whether you AGREE or DISAGREE with the following statements\.', '', column_name, flags=re.IGNORECASE)
-    name = re.sub(r'Please tell us.*', '', name, flags=re.IGNORECASE)
-    name = re.sub(r'\(optional\)', '', name, flags=re.IGNORECASE)
-    name = re.sub(r'[¿?.:!]', '', name)
+    name = _RE_AGREE_DISAGREE.sub('', column_name)
+    name = _RE_PLEASE_TELL_US.sub('', name)
+    name = _RE_OPTIONAL.sub('', name)
+    name = _RE_SIGNOS.sub('', name)
     words = name.strip().split()
     simplified = ''.join([word.capitalize() for word in words[:max_words]]) if words else column_name
     return sanitize_spss_varname(simplified)
 
+def basic_rename_map(column_names):
+    # Renombrado de respaldo sin LLM: simplificación básica + sufijos _N para nombres repetidos
+    column_names = list(column_names)
+    return dict(zip(column_names, make_unique_names(map(basic_column_simplifier, column_names))))
 
-def generate_variable_labels_llm(column_name_map, client, model=MODELO_LLM_PRINCIPAL):
-    if not client:
-        st.error("Error: El cliente de OpenAI no está inicializado.")
-        return None
-    if not column_name_map:
-        st.warning("La lista/mapa de nombres de columnas para generar etiquetas está vacía.")
-        return {}
-    if isinstance(column_name_map, list):
-        column_name_map_for_prompt = {name: name for name in column_name_map}
-    else:
-        column_name_map_for_prompt = column_name_map
-    items_for_prompt = "\n".join([f"- Nombre de Variable: \"{spss_name}\", Descripción/Pregunta Original: \"{original_desc}\"" for spss_name, original_desc in column_name_map_for_prompt.items()])
-    prompt = f"""
-Eres un asistente experto en preparar datos de encuestas para análisis estadístico en SPSS.
+
+_SISTEMA_ETIQUETAS = """
+Eres un experto en crear etiquetas de variable descriptivas para SPSS (max 256 caracteres). Devuelves solo JSON.
 Te proporcionaré una lista de NOMBRES DE VARIABLE (cortos, para SPSS) junto con su pregunta original o descripción.
 Tu tarea es, para CADA nombre de variable, generar una ETIQUETA DE VARIABLE descriptiva y clara para SPSS.
 
@@ -156,10 +437,18 @@ Consideraciones para las ETIQUETAS DE VARIABLE:
 4.  La longitud máxima de una etiqueta de variable en SPSS es 256 caracteres. Intenta no superarla.
 5.  Mantiene el mismo idioma que el original.
 
-
 Devuelve tu respuesta ÚNICAMENTE como un objeto JSON que mapee cada NOMBRE DE VARIABLE (el corto que te di) a su nueva ETIQUETA DE VARIABLE (la descriptiva).
 Asegúrate de que CADA nombre de variable de la lista de entrada tenga su correspondiente etiqueta en el JSON de salida.
 
+Formato JSON de salida esperado:
+{
+  "NombreVariable1": "Etiqueta Descriptiva para Variable 1",
+  "NombreVariable2": "Etiqueta Descriptiva para Variable 2",
+  ...
+}
+"""
+
+_EJEMPLOS_ETIQUETAS = """
 Ejemplos:
 - Nombre de Variable: "CorpInfluence", Pregunta Original: "Corporations and the wealthy have too much influence over government in this country.:Please say whether you AGREE or DISAGREE with the following statements."
   Etiqueta de Variable: "Influence of Corporations and Wealthy on Government"
@@ -173,57 +462,111 @@ Ejemplos:
   Etiqueta de Variable: "Imagen Diana Boluarte"
 - Nombre de Variable: "ImagenPresidente", Pregunta Original: "imagen_presidente"
   Etiqueta de Variable: "Imagen Presidente"
-
-Lista de nombres de variable y sus descripciones originales:
-{items_for_prompt}
-
-Formato JSON de salida esperado:
-{{
-  "NombreVariable1": "Etiqueta Descriptiva para Variable 1",
-  "NombreVariable2": "Etiqueta Descriptiva para Variable 2",
-  ...
-}}
 """
+
+def _generate_labels_chunk(column_name_map_for_prompt, client, model):
+    items_for_prompt = "\n".join([f"- Nombre de Variable: \"{spss_name}\", Descripción/Pregunta Original: \"{original_desc}\"" for spss_name, original_desc in column_name_map_for_prompt.items()])
+    prompt = f"Lista de nombres de variable y sus descripciones originales:\n{items_for_prompt}"
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "Eres un experto en crear etiquetas de variable descriptivas para SPSS (max 256 caracteres). Devuelves solo JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
+        llm_response_json = cached_chat(
+            client,
+            model,
+            _SISTEMA_ETIQUETAS if LLM_PROMPT_CONCISO else _SISTEMA_ETIQUETAS + _EJEMPLOS_ETIQUETAS,
+            prompt
         )
-        llm_response_json = response.choices[0].message.content
     except Exception as e:
         st.error(f"Error al llamar a la API de OpenAI para generar etiquetas de variable: {e}")
         return None
     try:
-        parsed_response = json.loads(llm_response_json)
+        parsed_response = json_loads(llm_response_json)
         if not isinstance(parsed_response, dict):
             st.error(f"Error: La respuesta del LLM para etiquetas de variable no es un diccionario: {parsed_response}")
             return None
-        final_labels = {key: str(value)[:256] for key, value in parsed_response.items()}
-        missing_keys = [name for name in column_name_map_for_prompt.keys() if name not in final_labels]
-        if missing_keys:
-            st.warning(f"Advertencia: El LLM no devolvió etiquetas para las siguientes variables: {missing_keys}")
-            for key in missing_keys:
-                final_labels[key] = str(column_name_map_for_prompt.get(key, key))[:256]
-        return final_labels
+        return {key: str(value)[:256] for key, value in parsed_response.items()}
     except json.JSONDecodeError as e:
         st.error(f"Error al decodificar JSON de la respuesta del LLM (etiquetas de variable): {e}")
         st.text_area("Respuesta recibida del LLM (etiquetas de variable):", llm_response_json, height=150)
         return None
 
-# --- NUEVA FUNCIÓN DE CODIFICACIÓN CATEGÓRICA ---
-def get_llm_categorical_encoding_suggestion(categories_list, client, model=MODELO_LLM_PRINCIPAL):
+def generate_variable_labels_llm(column_name_map, client, model=MODELO_LLM_PRINCIPAL):
     if not client:
         st.error("Error: El cliente de OpenAI no está inicializado.")
         return None
-    
-    categories_list_string = json.dumps(categories_list)
-    prompt = f"""
+    if not column_name_map:
+        st.warning("La lista/mapa de nombres de columnas para generar etiquetas está vacía.")
+        return {}
+    if isinstance(column_name_map, list):
+        column_name_map_for_prompt = {name: name for name in column_name_map}
+    else:
+        column_name_map_for_prompt = column_name_map
+    items = list(column_name_map_for_prompt.items())
+    lotes = [dict(items[i:i + LLM_COLUMNAS_POR_PETICION]) for i in range(0, len(items), LLM_COLUMNAS_POR_PETICION)]
+    resultados = run_llm_chunks(_generate_labels_chunk, lotes, client, model)
+    if all(resultado is None for resultado in resultados):
+        return None
+
+    final_labels = {}
+    for resultado in resultados:
+        if resultado:
+            final_labels.update(resultado)
+    missing_keys = [name for name in column_name_map_for_prompt.keys() if name not in final_labels]
+    if missing_keys:
+        st.warning(f"Advertencia: El LLM no devolvió etiquetas para las siguientes variables: {missing_keys}")
+        for key in missing_keys:
+            final_labels[key] = str(column_name_map_for_prompt.get(key, key))[:256]
+    return final_labels
+
+# --- NUEVA FUNCIÓN DE CODIFICACIÓN CATEGÓRICA ---
+# Salida estructurada estricta: el modelo no puede devolver valores no enteros ni omitir campos.
+# El modo estricto no admite claves dinámicas, así que columnas y mapeos se devuelven como listas de pares.
+_ESQUEMA_CODIFICACION = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "codificacion_categorias",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "columnas": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "columna": {"type": "string"},
+                            "needs_encoding": {"type": "boolean"},
+                            "mapping": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {"categoria": {"type": "string"}, "valor": {"type": "integer"}},
+                                    "required": ["categoria", "valor"],
+                                    "additionalProperties": False,
+                                },
+                            },
+                        },
+                        "required": ["columna", "needs_encoding", "mapping"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["columnas"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+_SISTEMA_CODIFICACION = "Eres un experto en codificación de datos de encuestas para SPSS. Analizas listas de categorías de varias columnas y devuelves el mapeo numérico de cada columna."
+
+# Las columnas se envían con identificadores posicionales (c0, c1...): los encabezados de Excel pueden ser
+# int o Timestamp, que no son claves JSON válidas y que el modelo devolvería siempre como texto
+def _ids_columnas(cols_to_categories):
+    return {f"c{i}": col for i, col in enumerate(cols_to_categories)}
+
+def _encoding_prompt(cols_to_categories):
+    columnas_y_categorias_string = json_dumps({id_col: cols_to_categories[col] for id_col, col in _ids_columnas(cols_to_categories).items()}, sort_keys=True)
+    return f"""
 Eres un asistente experto en preparar datos de encuestas para análisis estadístico en SPSS.
-Te proporcionaré una lista de categorías únicas de una columna de una encuesta. Tu tarea es analizar estas categorías y decidir si necesitan una codificación numérica especial.
+Te proporcionaré un objeto JSON que mapea el identificador de varias columnas de una encuesta a la lista de sus categorías únicas. Tu tarea es analizar, para CADA columna, sus categorías y decidir si necesitan una codificación numérica especial.
 
 Hay dos casos en los que se necesita codificación:
 
@@ -238,67 +581,369 @@ Las categorías principales no tienen un orden, pero hay opciones especiales com
 
 Si la variable es simplemente nominal sin categorías de escape (ej. ["Manzana", "Naranja", "Pera"]), entonces NO necesita codificación.
 
-Devuelve tu respuesta ÚNICAMENTE como un objeto JSON con esta estructura:
-{{
-  "needs_encoding": true_or_false,
-  "mapping_dict": {{ "categoria_1": numero_1, ... }}
-}}
+En "columnas" incluye un elemento por CADA columna de la entrada, con su identificador exacto en "columna".
+"needs_encoding" es true en el CASO 1 o CASO 2 y false si es una variable nominal simple.
+"mapping" contiene un par categoría/valor por cada categoría si needs_encoding es true, o una lista vacía si es false.
 
-- "needs_encoding": será `true` si es el CASO 1 o CASO 2. Será `false` si es una variable nominal simple.
-- "mapping_dict": El diccionario de mapeo si `needs_encoding` es `true`, o `null` si es `false`.
-- IMPORTANTE: Los valores en `mapping_dict` deben ser NÚMEROS enteros, no strings.
-
-Ejemplos de respuesta:
-- Input: ["Totalmente en desacuerdo", "En desacuerdo", "De acuerdo", "Totalmente de acuerdo"]
-  Output: {{"needs_encoding": true, "mapping_dict": {{"Totalmente de acuerdo": 1, "De acuerdo": 2, "En desacuerdo": 3, "Totalmente en desacuerdo": 4}}}}
-- Input: ["Malo", "Regular", "Bueno", "No aplica"]
-  Output: {{"needs_encoding": true, "mapping_dict": {{"Bueno": 1, "Regular": 2, "Malo": 3, "No aplica": 99}}}}
-- Input: ["Candidato A", "Candidato B", "Otro", "No sabe/No contesta"]
-  Output: {{"needs_encoding": true, "mapping_dict": {{"Candidato A": 1, "Candidato B": 2, "Otro": 98, "No sabe/No contesta": 99}}}}
-- Input: ["Rojo", "Verde", "Azul"]
-  Output: {{"needs_encoding": false, "mapping_dict": null}}
-- Input: ["1", "2", "3", "4", "5", "nan"]
-  Output: {{"needs_encoding": true, "mapping_dict": {{"1":1, "2":2, "3":3, "4":4, "5":5, "nan":99}}}}
-
-Lista de categorías a analizar:
-{categories_list_string}
+Ejemplos:
+- ["Totalmente en desacuerdo", "En desacuerdo", "De acuerdo", "Totalmente de acuerdo"] -> Totalmente de acuerdo=1, De acuerdo=2, En desacuerdo=3, Totalmente en desacuerdo=4
+- ["Malo", "Regular", "Bueno", "No aplica"] -> Bueno=1, Regular=2, Malo=3, No aplica=99
+- ["Candidato A", "Candidato B", "Otro", "No sabe/No contesta"] -> Candidato A=1, Candidato B=2, Otro=98, No sabe/No contesta=99
+- ["Rojo", "Verde", "Azul"] -> no necesita codificación
+- ["1", "2", "3", "4", "5", "nan"] -> 1=1, 2=2, 3=3, 4=4, 5=5, nan=99
+
+Columnas y categorías a analizar:
+{columnas_y_categorias_string}
 """
+
+def _encoding_suggestions_chunk(cols_to_categories, client, model):
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "Eres un experto en codificación de datos de encuestas para SPSS. Analizas listas de categorías y devuelves un JSON estructurado para el mapeo numérico. Los valores del mapeo deben ser números enteros."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
+        llm_response_json = cached_chat(
+            client,
+            model,
+            _SISTEMA_CODIFICACION,
+            _encoding_prompt(cols_to_categories),
+            response_format=_ESQUEMA_CODIFICACION
         )
-        llm_response_json = response.choices[0].message.content
     except Exception as e:
         st.error(f"Error al llamar a la API de OpenAI para codificación: {e}")
         return None
+    return _parse_encoding_response(llm_response_json, cols_to_categories)
+
+def _parse_encoding_response(llm_response_json, cols_to_categories):
     try:
-        parsed_response = json.loads(llm_response_json)
-        # Validación robusta de la respuesta
-        if not isinstance(parsed_response, dict) or "needs_encoding" not in parsed_response:
-             st.error(f"Respuesta de LLM para codificación no tiene el formato esperado: {parsed_response}")
-             return None
-
-        if parsed_response.get("needs_encoding") and isinstance(parsed_response.get("mapping_dict"), dict):
-            for k, v in parsed_response["mapping_dict"].items():
-                if not isinstance(v, (int, float)):
-                    st.warning(f"LLM devolvió un valor no numérico ('{v}') para la categoría '{k}'. Intentando convertir a int.")
-                    try:
-                        parsed_response["mapping_dict"][k] = int(v)
-                    except (ValueError, TypeError):
-                        st.error(f"No se pudo convertir '{v}' a int para la categoría '{k}'. Este mapeo podría ser inválido.")
-                        # Invalidar la sugerencia si hay un error de conversión grave
-                        return {"needs_encoding": False, "mapping_dict": None}
-        return parsed_response
+        parsed_response = json_loads(llm_response_json)
     except json.JSONDecodeError as e:
         st.error(f"Error al decodificar JSON de la respuesta del LLM (codificación): {e}")
         st.text_area("Respuesta recibida del LLM (codificación):", llm_response_json, height=150)
         return None
 
+    # Se vuelve al formato {columna: {"needs_encoding", "mapping_dict"}} que usan las cachés y la aplicación del mapeo
+    ids_columnas = _ids_columnas(cols_to_categories)
+    sugerencias = {}
+    for item in parsed_response["columnas"]:
+        if item["columna"] not in ids_columnas:
+            continue
+        mapeo = {par["categoria"]: par["valor"] for par in item["mapping"]}
+        sugerencias[ids_columnas[item["columna"]]] = {"needs_encoding": item["needs_encoding"] and bool(mapeo), "mapping_dict": mapeo or None}
+    missing_keys = [col for col in cols_to_categories if col not in sugerencias]
+    if missing_keys:
+        st.warning(f"Advertencia: El LLM no devolvió codificación para las siguientes columnas: {missing_keys}")
+    return sugerencias
+
+def _split_encoding_batches(cols_to_categories):
+    # Pocas columnas por petición (respuestas más cortas y en paralelo); cada lote sigue agrupando varias columnas
+    columnas = list(cols_to_categories)
+    return [{col: cols_to_categories[col] for col in columnas[i:i + LLM_COLUMNAS_POR_PETICION]} for i in range(0, len(columnas), LLM_COLUMNAS_POR_PETICION)]
+
+def get_llm_categorical_encoding_suggestions_bulk(cols_to_categories, client, model=MODELO_LLM_PRINCIPAL):
+    if not client:
+        st.error("Error: El cliente de OpenAI no está inicializado.")
+        return None
+    if not cols_to_categories:
+        return {}
+    lotes = _split_encoding_batches(cols_to_categories)
+    resultados = run_llm_chunks(_encoding_suggestions_chunk, lotes, client, model)
+    if all(resultado is None for resultado in resultados):
+        return None
+
+    sugerencias = {}
+    for resultado in resultados:
+        if resultado:
+            sugerencias.update(resultado)
+    return sugerencias
+
+# --- Modo batch (Batch API de OpenAI: mitad de precio, resultado en hasta 24 h) ---
+# Mismas peticiones que el modo interactivo, enviadas como un único trabajo. Las sugerencias se guardan en
+# la caché persistente de codificaciones, así que al volver a procesar el archivo se aplican sin consultar al LLM.
+def submit_encoding_batch(cols_to_categories, client, model=MODELO_LLM_PRINCIPAL):
+    lotes_por_id = {f"lote-{i}": lote for i, lote in enumerate(_split_encoding_batches(cols_to_categories))}
+    lineas = []
+    for custom_id, lote in lotes_por_id.items():
+        lineas.append(json_dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [
+                    {"role": "system", "content": _SISTEMA_CODIFICACION},
+                    {"role": "user", "content": _encoding_prompt(lote)}
+                ],
+                "response_format": _ESQUEMA_CODIFICACION,
+            },
+        }))
+    archivo = client.files.create(file=("codificacion.jsonl", "\n".join(lineas).encode("utf-8")), purpose="batch")
+    trabajo = client.batches.create(input_file_id=archivo.id, endpoint="/v1/chat/completions", completion_window="24h")
+    return {"id": trabajo.id, "lotes": lotes_por_id, "modelo": model}
+
+def pending_batch_category_sets(lotes_pendientes):
+    # Conjuntos de categorías (por modelo) ya enviados en lotes que aún no se han recogido
+    return {(lote_batch["modelo"], frozenset(categorias))
+            for lote_batch in lotes_pendientes for lote in lote_batch["lotes"].values() for categorias in lote.values()}
+
+def collect_encoding_batch(lote_batch, client):
+    # Devuelve (estado, sugerencias por conjunto de categorías); las sugerencias solo cuando el trabajo ha terminado
+    trabajo = client.batches.retrieve(lote_batch["id"])
+    if trabajo.status != "completed":
+        return trabajo.status, None
+    sugerencias = {}
+    if not trabajo.output_file_id:
+        return trabajo.status, sugerencias
+    for linea in client.files.content(trabajo.output_file_id).text.splitlines():
+        if not linea.strip():
+            continue
+        resultado = json_loads(linea)
+        lote = lote_batch["lotes"].get(resultado.get("custom_id"))
+        respuesta = resultado.get("response") or {}
+        if lote is None or respuesta.get("status_code") != 200:
+            continue
+        parcial = _parse_encoding_response(respuesta["body"]["choices"][0]["message"]["content"], lote)
+        if parcial:
+            sugerencias.update({(lote_batch["modelo"], frozenset(lote[col])): sugerencia for col, sugerencia in parcial.items() if sugerencia})
+    return trabajo.status, sugerencias
+
+def poll_encoding_batch(lote_batch, client, ahora):
+    # Una sola consulta, sin esperas, y solo si ya le toca al lote: tras cada consulta la espera se duplica
+    # (5, 10, 20... s, hasta LOTE_ESPERA_MAXIMA). Devuelve (None, None) si aún no toca consultarlo
+    if ahora < lote_batch.get("proxima_consulta", 0):
+        return None, None
+    espera = min(2 * lote_batch["espera"], LOTE_ESPERA_MAXIMA) if "espera" in lote_batch else LOTE_INTERVALO_PANEL
+    lote_batch.update(espera=espera, proxima_consulta=ahora + espera)
+    estado, sugerencias = collect_encoding_batch(lote_batch, client)
+    lote_batch["estado"] = estado
+    return estado, sugerencias
+
+
+# --- Carga de Archivos y Cliente (cacheados entre reruns) ---
+# calamine (python-calamine, en Rust) lee .xlsx mucho más rápido que openpyxl; si no está instalado
+# se usa openpyxl, que pandas ya abre en modo read_only
+EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else "openpyxl"
+# El lector de CSV de pyarrow es multihilo; se mantienen los dtypes de numpy (pyreadstat no documenta soporte para ArrowDtype)
+CSV_ENGINE = "pyarrow" if importlib.util.find_spec("pyarrow") else "c"
+# /dev/shm es tmpfs en Linux: el .sav temporal se escribe y se lee en memoria en lugar de en disco
+SAV_TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+# CSV grandes: se leen por bloques y el texto de cada bloque pasa a 'category' antes de juntarlos,
+# así nunca está el archivo entero en memoria como objetos str
+CSV_BYTES_LECTURA_POR_BLOQUES = 200 * 1024 * 1024
+CSV_FILAS_POR_BLOQUE = 100_000
+
+def _concat_column_chunks(partes):
+    # Junta los trozos de una columna; si alguno es categórico el resultado también lo es
+    if not any(isinstance(parte.dtype, pd.CategoricalDtype) for parte in partes):
+        return pd.concat(partes, ignore_index=True)
+    try:
+        return pd.Series(union_categoricals([as_categorical(parte) for parte in partes], ignore_order=True), name=partes[0].name)
+    except TypeError:
+        # Categorías de tipos distintos entre bloques (ej. solo números en uno, texto en otro)
+        return pd.concat([parte.astype(object) for parte in partes], ignore_index=True).astype('category')
+
+def read_csv_by_chunks(buffer):
+    bloques = []
+    # El motor pyarrow no admite chunksize
+    for bloque in pd.read_csv(buffer, engine="c", chunksize=CSV_FILAS_POR_BLOQUE):
+        for col in bloque.select_dtypes(include='object').columns:
+            bloque[col] = bloque[col].astype('category')
+        bloques.append(bloque)
+    if len(bloques) == 1:
+        return bloques[0]
+    columnas = {col: _concat_column_chunks([bloque[col] for bloque in bloques]) for col in bloques[0].columns}
+    return pd.DataFrame(columnas)
+
+def read_csv_fast(file_bytes):
+    df = pd.read_csv(io.BytesIO(file_bytes), engine=CSV_ENGINE)
+    if CSV_ENGINE != "pyarrow":
+        return df
+    # El lector de pyarrow no renombra los encabezados repetidos (el motor C los deja como x, x.1): se relee con el motor C
+    if df.columns.has_duplicates:
+        return pd.read_csv(io.BytesIO(file_bytes), engine="c")
+    # pyarrow convierte en fechas u horas las columnas con formato ISO-8601 y en float64 los enteros que no caben
+    # en int64; el motor C deja las primeras como texto y los enteros como uint64 o texto. Esas columnas se vuelven
+    # a leer con el motor C para que el tipo en el .sav no dependa del motor ni del tamaño del archivo
+    posiciones_motor_c = [
+        i for i, dtype in enumerate(df.dtypes)
+        if pd.api.types.is_datetime64_any_dtype(dtype)
+        or (dtype == object and pd.api.types.infer_dtype(df.iloc[:, i], skipna=True) in ("date", "datetime", "time"))
+        or (dtype.kind == 'f' and (df.iloc[:, i].abs() >= 2**63).any())
+    ]
+    if posiciones_motor_c:
+        releidas = pd.read_csv(io.BytesIO(file_bytes), engine="c", usecols=posiciones_motor_c)
+        for i, posicion in enumerate(posiciones_motor_c):
+            df.isetitem(posicion, releidas.iloc[:, i])
+    return df
+
+@st.cache_data(show_spinner=False)
+def load_df(file_bytes, name):
+    if name.endswith('.csv') and len(file_bytes) > CSV_BYTES_LECTURA_POR_BLOQUES:
+        df = read_csv_by_chunks(io.BytesIO(file_bytes))
+    elif name.endswith('.csv'):
+        df = read_csv_fast(file_bytes)
+    else:
+        df = pd.read_excel(io.BytesIO(file_bytes), engine=EXCEL_ENGINE)
+    # Las columnas de texto se guardan como 'category': las categorías únicas quedan disponibles
+    # sin recorrer las filas y cada valor ocupa un código entero en lugar de un objeto str
+    for col in df.select_dtypes(include='object').columns:
+        df[col] = df[col].astype('category')
+    # Los enteros sin nulos se reducen al tipo más estrecho; el .sav los escribe igual como numéricos
+    for col in df.select_dtypes(include='integer').columns:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+    return df
+
+@st.cache_data(show_spinner=False)
+def compute_unique_categories(file_bytes, name):
+    # Categorías únicas normalizadas (strip, '' -> 'nan') de cada columna no numérica, calculadas una vez por archivo.
+    # La lista solo se materializa para columnas dentro del límite del LLM; del resto (ej. texto libre) basta el número.
+    df = load_df(file_bytes, name)
+    categorias_por_columna = {}
+    num_categorias = {}
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_numeric_dtype(dtype):
+            continue
+        try:
+            categorias = normalize_categories(as_categorical(df[col]).cat.categories).unique()
+        except Exception:
+            continue
+        num_categorias[col] = len(categorias)
+        if len(categorias) <= MAX_CATEGORIAS_PARA_LLM:
+            categorias_por_columna[col] = categorias.tolist()
+    return categorias_por_columna, num_categorias
+
+@st.cache_resource
+def get_openai_client(api_key):
+    # Import diferido: openai solo se carga cuando hay API key (Streamlit re-ejecuta el script en cada interacción)
+    import openai
+    return openai.OpenAI(api_key=api_key)
+
+def _as_sav_text(serie):
+    # pyreadstat exige str de Python (no numpy.str_): en las categóricas se construye la tabla de textos de las
+    # k categorías (más 'nan' para el código -1, como hacía astype(str) sobre object) y se reparte por código
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        textos = np.array([str(c) for c in serie.cat.categories] + ['nan'], dtype=object)
+        return pd.Series(textos[serie.cat.codes.to_numpy()], index=serie.index)
+    return serie.astype(str)
+
+# --- Generación del archivo .sav (cacheada entre reruns) ---
+# Cada interacción con la página vuelve a ejecutar el script: la sanitización y la escritura del .sav solo se repiten
+# si cambia el resultado del procesamiento. _df_processed no se hashea; 'version' identifica cada procesamiento.
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_sav(_df_processed, variable_labels, value_labels, compress, version):
+    # Sin copia profunda: set_axis devuelve un nuevo DataFrame y, con Copy-on-Write, solo se copian
+    # las columnas cuyo tipo se cambie más abajo; el DataFrame de session_state no se modifica
+    df_to_write = _df_processed
+    
+    sanitization_log_messages = ["\n--- Iniciando Sanitización Final y Preparación para .sav ---"]
+
+    current_col_names_before_final_sanitize = list(df_to_write.columns)
+    
+    final_spss_variable_labels_for_sav = {}
+    final_spss_value_labels_for_sav = {}
+    
+    final_sav_column_names = make_unique_names(map(sanitize_spss_varname, current_col_names_before_final_sanitize))
+
+    for col_name_in_df_to_write, unique_final_name in zip(current_col_names_before_final_sanitize, final_sav_column_names):
+        final_spss_variable_labels_for_sav[unique_final_name] = variable_labels.get(col_name_in_df_to_write) or str(col_name_in_df_to_write)[:256]
+
+        etiquetas_valor = value_labels.get(col_name_in_df_to_write)
+        if etiquetas_valor is not None:
+            final_spss_value_labels_for_sav[unique_final_name] = etiquetas_valor
+        
+        if col_name_in_df_to_write != unique_final_name:
+             sanitization_log_messages.append(f"  Nombre de columna final para SPSS: '{col_name_in_df_to_write}' -> '{unique_final_name}'")
+
+    df_to_write = df_to_write.set_axis(final_sav_column_names, axis=1)
+    sanitization_log_messages.append("Nombres de columna finales aplicados a df_to_write.")
+    
+    # El bucle anterior asigna una etiqueta a cada nombre final, en el mismo orden que las columnas
+    column_labels_list_for_sav = list(final_spss_variable_labels_for_sav.values())
+    
+    spss_missing_ranges = {}
+    tipos_a_escribir = df_to_write.dtypes.to_dict()
+    # Las columnas ya numéricas (incluidas las codificadas) no necesitan ninguna conversión: se separan de entrada
+    # y solo se recorren las de texto. dtype.kind cubre también los tipos extendidos (Int64 -> 'i', Float64 -> 'f', boolean -> 'b')
+    # ('category', object y string tienen kind 'O')
+    columnas_numericas = {col for col, dtype_col in tipos_a_escribir.items() if dtype_col.kind in 'biufc'}
+    if columnas_numericas:
+        sanitization_log_messages.append(f"  {len(columnas_numericas)} columnas numéricas: NaN se tratará como system missing.")
+    for col in df_to_write.columns:
+        if col in columnas_numericas:
+            continue
+        dtype_col = tipos_a_escribir[col]
+        es_categorica = isinstance(dtype_col, pd.CategoricalDtype)
+        if es_categorica or dtype_col == object:
+            try:
+                serie = df_to_write[col]
+                # Las columnas de texto se cargaron como 'category': la detección numérica se hace sobre las k categorías
+                # y el resultado se reparte por código, sin convertir las n filas a 'object'
+                valores = pd.Series(dtype_col.categories) if es_categorica else serie
+                numeric_series = pd.to_numeric(valores, errors='coerce')
+                if numeric_series.notna().any():
+                    # Los valores que no se pudieron convertir solo pueden ser vacíos o 'nan' (comprobación vectorizada)
+                    original_values_that_became_nan = valores[numeric_series.isna() & valores.notna()]
+                    is_potentially_numeric = original_values_that_became_nan.astype(str).str.strip().str.lower().isin(('', 'nan')).all()
+                    
+                    if is_potentially_numeric:
+                        if es_categorica:
+                            valores_por_codigo = np.append(numeric_series.to_numpy(dtype='float64'), np.nan)
+                            df_to_write[col] = pd.Series(valores_por_codigo[serie.cat.codes.to_numpy()], index=serie.index)
+                        else:
+                            df_to_write[col] = numeric_series
+                        sanitization_log_messages.append(f"  Columna '{col}' convertida a tipo numérico.")
+                    else:
+                        df_to_write[col] = _as_sav_text(df_to_write[col])
+                        spss_missing_ranges[col] = ['nan']
+                        sanitization_log_messages.append(f"  Columna '{col}' tratada como string. Missing range ['nan'] aplicado.")
+                else:
+                    df_to_write[col] = _as_sav_text(df_to_write[col])
+                    spss_missing_ranges[col] = ['nan']
+                    sanitization_log_messages.append(f"  Columna '{col}' (todo NaN o no numérico) tratada como string. Missing range ['nan'] aplicado.")
+
+            except (ValueError, TypeError): 
+                df_to_write[col] = _as_sav_text(df_to_write[col])
+                spss_missing_ranges[col] = ['nan'] 
+                sanitization_log_messages.append(f"  Columna '{col}' (error en conversión) tratada como string. Missing range ['nan'] aplicado.")
+
+        elif pd.api.types.is_string_dtype(dtype_col):
+            spss_missing_ranges[col] = ['nan']
+            sanitization_log_messages.append(f"  Columna '{col}' (tipo string) con missing range ['nan'] aplicado.")
+
+    sanitization_log_messages.append("--- Fin de Sanitización Final y Preparación ---")
+
+    # pyreadstat solo escribe a una ruta: se usa un directorio temporal que se borra solo al salir del bloque.
+    # Primero en memoria (tmpfs); si no cabe o falla, en el directorio temporal por defecto.
+    import pyreadstat # Import diferido: solo se necesita al generar la descarga
+    extension_salida = ".zsav" if compress else ".sav"
+    directorios = [SAV_TMP_DIR, None] if SAV_TMP_DIR else [None]
+    for intento, directorio in enumerate(directorios):
+        try:
+            with tempfile.TemporaryDirectory(dir=directorio, ignore_cleanup_errors=True) as temp_dir:
+                temp_file_path = os.path.join(temp_dir, f"datos{extension_salida}")
+                pyreadstat.write_sav(
+                    df_to_write, 
+                    temp_file_path, 
+                    column_labels=column_labels_list_for_sav, 
+                    variable_value_labels=final_spss_value_labels_for_sav,
+                    missing_ranges=spss_missing_ranges,
+                    compress=compress
+                )
+
+                # Se lee de vuelta sin buffer intermedio: FileIO.readall reserva el tamaño exacto del archivo y lo lee de una vez
+                with open(temp_file_path, "rb", buffering=0) as f:
+                    sav_bytes = f.read()
+            break
+        except Exception:
+            if intento == len(directorios) - 1:
+                raise
+    return sav_bytes, sanitization_log_messages
+
+# --- Log del proceso ---
+# El log es acotado (deque) y el texto unido se guarda al modificarlo, no en cada rerun que lo muestra
+def reset_log(mensajes=()):
+    st.session_state.log_messages = deque(mensajes, maxlen=LOG_MAX_MENSAJES)
+    st.session_state.log_text = "\n".join(st.session_state.log_messages)
+
+def extend_log(mensajes):
+    st.session_state.log_messages.extend(mensajes)
+    st.session_state.log_text = "\n".join(st.session_state.log_messages)
 
 # --- Interfaz de Streamlit ---
 st.sidebar.header("🔑 Configuración de OpenAI")
@@ -306,7 +951,7 @@ api_key_input = st.sidebar.text_input("Ingresa tu OpenAI API Key", type="passwor
 openai_client = None
 if api_key_input:
     try:
-        openai_client = openai.OpenAI(api_key=api_key_input)
+        openai_client = get_openai_client(api_key_input)
         st.sidebar.success("Cliente de OpenAI inicializado.")
     except Exception as e:
         st.sidebar.error(f"Error al inicializar OpenAI: {e}")
@@ -314,6 +959,11 @@ if api_key_input:
 else:
     st.sidebar.info("Ingresa una API Key de OpenAI para usar las funciones basadas en LLM.")
 
+if st.sidebar.button("🗑️ Vaciar caché de respuestas LLM", help="Elimina las respuestas y codificaciones del LLM guardadas en disco y en esta sesión."):
+    clear_llm_cache()
+    st.session_state.codificaciones_cache = {}
+    st.sidebar.success("Caché de respuestas LLM vaciada.")
+
 st.sidebar.header("📂 Cargar Archivo")
 uploaded_file = st.sidebar.file_uploader("Sube tu archivo CSV o Excel", type=["csv", "xlsx"])
 
@@ -324,6 +974,8 @@ do_generate_var_labels = st.sidebar.checkbox("Generar etiquetas de variables (Et
 do_encode_categorical = st.sidebar.checkbox("Codificar variables categóricas (Ordinales y de Escape)", value=True)
 
 encoding_mode = "Crear nuevas columnas (ej. VarName_num)"
+use_batch_mode = False
+modelo_codificacion = MODELO_LLM_PRINCIPAL
 if do_encode_categorical:
     # --- MODIFICADO --- Título del radio para reflejar la nueva funcionalidad
     encoding_mode = st.sidebar.radio(
@@ -332,234 +984,314 @@ if do_encode_categorical:
         index=0,
         help="Elige si las columnas codificadas reemplazan a las originales o se crean como nuevas."
     )
+    modelo_codificacion = st.sidebar.selectbox("Modelo para codificación categórica", MODELOS_CODIFICACION, index=MODELOS_CODIFICACION.index(MODELO_LLM_PRINCIPAL), help="Los modelos mini/nano bastan para mapear listas cortas de categorías y son más rápidos y baratos.")
+    use_batch_mode = st.sidebar.checkbox("Modo batch (más barato, asíncrono)", value=False, help="Envía las categorías pendientes a la Batch API de OpenAI (mitad de precio, hasta 24 h). Cuando el lote termine, vuelve a procesar el archivo para aplicar las codificaciones.")
+
+compress_sav = st.sidebar.checkbox("Comprimir archivo de salida (.zsav)", value=True, help="Formato comprimido de SPSS (zlib): archivo más pequeño y descarga más rápida. Requiere SPSS 21 o superior.")
 
 if 'df_processed' not in st.session_state: st.session_state.df_processed = None
+if 'df_version' not in st.session_state: st.session_state.df_version = None
+if 'sav_log_version' not in st.session_state: st.session_state.sav_log_version = None
 if 'spss_variable_labels' not in st.session_state: st.session_state.spss_variable_labels = {}
 if 'spss_value_labels' not in st.session_state: st.session_state.spss_value_labels = {}
 if 'spss_missing_ranges' not in st.session_state: st.session_state.spss_missing_ranges = {}
 if 'codificaciones_cache' not in st.session_state: st.session_state.codificaciones_cache = {}
-if 'log_messages' not in st.session_state: st.session_state.log_messages = []
+if 'log_text' not in st.session_state: reset_log()
+if 'unique_cache' not in st.session_state: st.session_state.unique_cache = {}
+if 'unique_counts' not in st.session_state: st.session_state.unique_counts = {}
+if 'lotes_codificacion' not in st.session_state: st.session_state.lotes_codificacion = []
+if 'avisos_lotes' not in st.session_state: st.session_state.avisos_lotes = []
+
+# Lotes de codificación pendientes: los ids quedan en la sesión y el panel es un fragmento que se vuelve a
+# ejecutar solo cada LOTE_INTERVALO_PANEL s; cada lote se consulta con backoff sin bloquear el resto del script
+@st.fragment(run_every=LOTE_INTERVALO_PANEL)
+def encoding_batches_panel(client):
+    lotes_pendientes = st.session_state.lotes_codificacion
+    if not lotes_pendientes:
+        return
+    st.caption("Lotes de codificación en curso: " + ", ".join(f"`{lote_batch['id']}` ({lote_batch.get('estado', 'enviado')})" for lote_batch in lotes_pendientes))
+    comprobar_ya = st.button("🔄 Comprobar lotes de codificación")
+    ahora = time.time()
+    lotes_en_curso = []
+    for lote_batch in lotes_pendientes:
+        if comprobar_ya:
+            lote_batch["proxima_consulta"] = 0
+        try:
+            estado_lote, sugerencias_lote = poll_encoding_batch(lote_batch, client, ahora)
+        except Exception as e:
+            st.error(f"Error al consultar el lote de codificación {lote_batch['id']}: {e}")
+            lotes_en_curso.append(lote_batch)
+            continue
+        if estado_lote == "completed":
+            st.session_state.codificaciones_cache.update(sugerencias_lote)
+            if sugerencias_lote:
+                store_encodings(sugerencias_lote)
+            st.session_state.avisos_lotes.append(("success", f"Lote {lote_batch['id']} completado: {len(sugerencias_lote)} codificaciones guardadas. Vuelve a procesar el archivo para aplicarlas."))
+        elif estado_lote in ("failed", "expired", "cancelled"):
+            st.session_state.avisos_lotes.append(("error", f"El lote de codificación {lote_batch['id']} terminó con estado '{estado_lote}'."))
+        else:
+            lotes_en_curso.append(lote_batch)
+    st.session_state.lotes_codificacion = lotes_en_curso
+    # Un lote terminado cambia lo que muestra el resto de la página: rerun completo para enseñar los avisos
+    if len(lotes_en_curso) < len(lotes_pendientes):
+        st.rerun()
+
+for nivel_aviso, aviso in st.session_state.avisos_lotes:
+    getattr(st.sidebar, nivel_aviso)(aviso)
+st.session_state.avisos_lotes = []
+if openai_client and (use_batch_mode or st.session_state.lotes_codificacion):
+    with st.sidebar:
+        encoding_batches_panel(openai_client)
 
 
 if uploaded_file is not None:
     st.subheader("Vista Previa del Archivo Original")
+    local_log = None
     try:
-        if uploaded_file.name.endswith('.csv'):
-            df_original = pd.read_csv(uploaded_file)
-        else:
-            df_original = pd.read_excel(uploaded_file)
+        file_bytes = uploaded_file.getvalue()
+        df_original = load_df(file_bytes, uploaded_file.name)
+        st.session_state.unique_cache, st.session_state.unique_counts = compute_unique_categories(file_bytes, uploaded_file.name)
         st.dataframe(df_original.head())
 
         if st.sidebar.button("🚀 Procesar Datos para .sav"):
             with st.spinner("Procesando datos... Por favor espera."):
-                df_processed = df_original.copy()
-                st.session_state.log_messages = []
+                # Con Copy-on-Write la copia superficial no duplica datos: solo se copian las columnas que se modifiquen
+                df_processed = df_original.copy(deep=False)
+                # Los mensajes se acumulan en una lista local y se publican en session_state una sola vez al final
+                local_log = []
                 
                 spss_variable_labels_dict = {} 
                 spss_value_labels_dict = {}  
                 original_to_simplified_map_for_labels = {col: col for col in df_processed.columns}
 
+                # 0. Preparar la codificación categórica: la consulta al LLM se lanza en segundo plano
+                # y se ejecuta mientras se simplifican los nombres y se generan las etiquetas.
+                columnas_candidatas = {}
+                futuro_sugerencias = None
+                columnas_sin_cache = {}
+                firmas_consultadas = set()
+                if do_encode_categorical and openai_client:
+                    # Máscara de columnas numéricas calculada una sola vez a partir de los dtypes
+                    tipos_originales = df_original.dtypes.to_dict()
+                    es_numerica = {c: pd.api.types.is_numeric_dtype(t) for c, t in tipos_originales.items()}
+                    for nombre_col_df_original in df_original.columns:
+                        if es_numerica[nombre_col_df_original]:
+                            local_log.append(f"Omitiendo '{nombre_col_df_original}' para codificación: Ya es de tipo numérico ({tipos_originales[nombre_col_df_original]}).")
+                            continue
+                        
+                        num_categorias = st.session_state.unique_counts.get(nombre_col_df_original)
+                        if num_categorias is None:
+                            local_log.append(f"Error al obtener categorías únicas de '{nombre_col_df_original}'. Omitiendo.")
+                            continue
+                        
+                        if not (1 < num_categorias <= MAX_CATEGORIAS_PARA_LLM):
+                            local_log.append(f"Omitiendo '{nombre_col_df_original}' para codificación: {num_categorias} categorías (fuera del límite 1-{MAX_CATEGORIAS_PARA_LLM}).")
+                            continue
+
+                        columnas_candidatas[nombre_col_df_original] = st.session_state.unique_cache[nombre_col_df_original]
+
+                    # Muchas columnas (ej. baterías Likert) comparten exactamente las mismas categorías:
+                    # se consulta una sola vez por conjunto distinto, usando la primera columna como representante.
+                    # La clave es (modelo, frozenset) (no depende del orden); solo se ordena lo que se envía al LLM.
+                    conjuntos_pendientes = {(modelo_codificacion, frozenset(c)) for c in columnas_candidatas.values()} - st.session_state.codificaciones_cache.keys()
+                    if conjuntos_pendientes:
+                        st.session_state.codificaciones_cache.update(load_stored_encodings(conjuntos_pendientes))
+                    for col, categorias in columnas_candidatas.items():
+                        clave_cache = (modelo_codificacion, frozenset(categorias))
+                        if clave_cache in st.session_state.codificaciones_cache or clave_cache in firmas_consultadas:
+                            continue
+                        sugerencia_local = classify_categories_locally(categorias)
+                        if sugerencia_local:
+                            local_log.append(f"Categorías de '{col}' son números enteros: codificación directa sin consultar al LLM.")
+                            st.session_state.codificaciones_cache[clave_cache] = sugerencia_local
+                        else:
+                            firmas_consultadas.add(clave_cache)
+                            columnas_sin_cache[col] = sorted(categorias)
+                    if columnas_sin_cache and use_batch_mode:
+                        # Los conjuntos que ya están en un lote pendiente no se vuelven a enviar (ni a pagar)
+                        ya_enviados = pending_batch_category_sets(st.session_state.lotes_codificacion)
+                        columnas_a_enviar = {col: categorias for col, categorias in columnas_sin_cache.items() if (modelo_codificacion, frozenset(categorias)) not in ya_enviados}
+                        if len(columnas_a_enviar) < len(columnas_sin_cache):
+                            local_log.append(f"{len(columnas_sin_cache) - len(columnas_a_enviar)} conjuntos de categorías ya están en un lote pendiente; no se reenvían.")
+                        if columnas_a_enviar:
+                            try:
+                                lote_batch = submit_encoding_batch(columnas_a_enviar, client=openai_client, model=modelo_codificacion)
+                                st.session_state.lotes_codificacion.append(lote_batch)
+                                local_log.append(f"Enviado lote de codificación {lote_batch['id']} para {len(columnas_a_enviar)} conjuntos distintos de categorías: {list(columnas_a_enviar)}. Estas columnas se codificarán al volver a procesar cuando el lote termine.")
+                            except Exception as e:
+                                st.error(f"Error al enviar el lote de codificación a OpenAI: {e}")
+                    elif columnas_sin_cache:
+                        local_log.append(f"Consultando LLM en segundo plano, en peticiones agrupadas, para {len(columnas_sin_cache)} conjuntos distintos de categorías ({len(columnas_candidatas)} columnas candidatas): {list(columnas_sin_cache)}.")
+                        llm_executor = _crear_executor_llm(max_workers=1)
+                        futuro_sugerencias = llm_executor.submit(get_llm_categorical_encoding_suggestions_bulk, columnas_sin_cache, client=openai_client, model=modelo_codificacion)
+                        llm_executor.shutdown(wait=False)
+
                 # 1. Simplificar Nombres de Columnas
                 if do_simplify_cols:
                     # ... (Esta sección no necesita cambios, se deja como está)
-                    st.session_state.log_messages.append("--- Iniciando Simplificación de Nombres de Columnas ---")
+                    local_log.append("--- Iniciando Simplificación de Nombres de Columnas ---")
+                    usar_fallback_basico = False
                     if openai_client:
                         original_column_names_list = df_processed.columns.tolist()
                         with st.spinner("Simplificando nombres de columnas (Nombres de Variable SPSS) con LLM..."):
                             simplified_names_map_llm = simplify_survey_column_names_llm(original_column_names_list, client=openai_client)
 
                         if simplified_names_map_llm:
-                            st.session_state.log_messages.append("Mapa de nombres de variable simplificados (LLM) obtenido.")
-                            final_rename_map_llm = {}
-                            seen_llm_names = set()
-                            for original_name in original_column_names_list:
-                                proposed_name = simplified_names_map_llm.get(original_name, basic_column_simplifier(original_name))
-                                unique_name = proposed_name
-                                count = 1
-                                while unique_name in seen_llm_names:
-                                    unique_name = f"{proposed_name[:SPSS_VAR_NAME_MAX_LEN - (len(str(count))+1)]}_{count}"
-                                    count += 1
-                                seen_llm_names.add(unique_name)
-                                final_rename_map_llm[original_name] = unique_name
+                            local_log.append("Mapa de nombres de variable simplificados (LLM) obtenido.")
+                            proposed_names = [simplified_names_map_llm.get(original_name, basic_column_simplifier(original_name)) for original_name in original_column_names_list]
+                            nuevos_nombres = make_unique_names(proposed_names)
+                            final_rename_map_llm = dict(zip(original_column_names_list, nuevos_nombres))
                             
-                            df_processed.rename(columns=final_rename_map_llm, inplace=True)
+                            # Se reemplazan todos los nombres a la vez: set_axis asigna el nuevo índice de columnas por posición
+                            df_processed = df_processed.set_axis(nuevos_nombres, axis=1)
                             original_to_simplified_map_for_labels = {orig: final_rename_map_llm.get(orig, orig) for orig in original_column_names_list}
-                            st.session_state.log_messages.append("Nombres de columna (variables SPSS) simplificados y aplicados.")
+                            local_log.append("Nombres de columna (variables SPSS) simplificados y aplicados.")
                         else: 
-                            st.session_state.log_messages.append("No se pudieron simplificar los nombres con LLM. Usando fallback básico para todos.")
-                            fb_rename_map = {name: basic_column_simplifier(name) for name in df_processed.columns}
-                            unique_fb_map = {}
-                            seen_fb_names = set()
-                            for orig, simpl in fb_rename_map.items():
-                                uname = simpl
-                                c = 1
-                                while uname in seen_fb_names:
-                                    uname = f"{simpl[:SPSS_VAR_NAME_MAX_LEN-(len(str(c))+1)]}_{c}"
-                                    c+=1
-                                seen_fb_names.add(uname)
-                                unique_fb_map[orig] = uname
-                            df_processed.rename(columns=unique_fb_map, inplace=True)
-                            original_to_simplified_map_for_labels = {orig: unique_fb_map.get(orig, orig) for orig in df_original.columns}
+                            local_log.append("No se pudieron simplificar los nombres con LLM. Usando fallback básico para todos.")
+                            usar_fallback_basico = True
                     else: 
-                        st.session_state.log_messages.append("Cliente OpenAI no configurado. Aplicando simplificación básica de renombrado.")
-                        fb_rename_map = {name: basic_column_simplifier(name) for name in df_processed.columns}
-                        unique_fb_map = {}
-                        seen_fb_names = set()
-                        for orig, simpl in fb_rename_map.items():
-                            uname = simpl
-                            c = 1
-                            while uname in seen_fb_names:
-                                uname = f"{simpl[:SPSS_VAR_NAME_MAX_LEN-(len(str(c))+1)]}_{c}"
-                                c+=1
-                            seen_fb_names.add(uname)
-                            unique_fb_map[orig] = uname
-                        df_processed.rename(columns=unique_fb_map, inplace=True)
-                        original_to_simplified_map_for_labels = {orig: unique_fb_map.get(orig, orig) for orig in df_original.columns}
-                    st.session_state.log_messages.append("--- Fin de Simplificación de Nombres ---")
+                        local_log.append("Cliente OpenAI no configurado. Aplicando simplificación básica de renombrado.")
+                        usar_fallback_basico = True
+                    if usar_fallback_basico:
+                        original_to_simplified_map_for_labels = basic_rename_map(df_processed.columns)
+                        df_processed = df_processed.set_axis([original_to_simplified_map_for_labels[col] for col in df_processed.columns], axis=1)
+                    local_log.append("--- Fin de Simplificación de Nombres ---")
 
 
+                # Mapa inverso (nombre actual -> nombre/pregunta original), construido una vez y usado en los pasos 2 y 3
+                simplified_to_original = {simpl: orig for orig, simpl in original_to_simplified_map_for_labels.items()}
+                map_current_name_to_original_question = {col: simplified_to_original.get(col, col) for col in df_processed.columns}
+
                 # 2. Generar Etiquetas de Variable
                 if do_generate_var_labels:
-                    # ... (Esta sección no necesita cambios, se deja como está)
-                    st.session_state.log_messages.append("\n--- Iniciando Generación de Etiquetas de Variable ---")
+                    local_log.append("\n--- Iniciando Generación de Etiquetas de Variable ---")
                     if openai_client:
-                        map_current_name_to_original_question = {}
-                        for original_q_name, current_df_proc_name in original_to_simplified_map_for_labels.items():
-                            if current_df_proc_name in df_processed.columns:
-                                map_current_name_to_original_question[current_df_proc_name] = original_q_name
-                            else: 
-                                if not do_simplify_cols and original_q_name in df_processed.columns:
-                                     map_current_name_to_original_question[original_q_name] = original_q_name
-                        if not map_current_name_to_original_question: 
-                            map_current_name_to_original_question = {col: col for col in df_processed.columns}
-                        
                         with st.spinner("Generando etiquetas de variable (Etiquetas SPSS) con LLM..."):
                             generated_labels = generate_variable_labels_llm(map_current_name_to_original_question, client=openai_client)
                         
                         if generated_labels:
                             spss_variable_labels_dict = generated_labels 
-                            st.session_state.log_messages.append("Etiquetas de variable generadas por LLM.")
+                            local_log.append("Etiquetas de variable generadas por LLM.")
                         else:
-                            st.session_state.log_messages.append("No se pudieron generar etiquetas de variable con LLM. Usando pregunta original/nombre de columna como fallback.")
-                            spss_variable_labels_dict = {col: str(map_current_name_to_original_question.get(col, col))[:256] for col in df_processed.columns} 
+                            local_log.append("No se pudieron generar etiquetas de variable con LLM. Usando pregunta original/nombre de columna como fallback.")
+                            spss_variable_labels_dict = {col: str(orig)[:256] for col, orig in map_current_name_to_original_question.items()}
                     else: 
-                        st.session_state.log_messages.append("Cliente OpenAI no configurado para etiquetas de variable. Usando pregunta original/nombre de columna como fallback.")
-                        map_current_name_to_original_question_fallback = {}
-                        for original_q_name, current_df_proc_name in original_to_simplified_map_for_labels.items():
-                            if current_df_proc_name in df_processed.columns:
-                                map_current_name_to_original_question_fallback[current_df_proc_name] = original_q_name
-                            elif not do_simplify_cols and original_q_name in df_processed.columns:
-                                map_current_name_to_original_question_fallback[original_q_name] = original_q_name
-                        if not map_current_name_to_original_question_fallback:
-                             map_current_name_to_original_question_fallback = {col: col for col in df_processed.columns}
-
-                        spss_variable_labels_dict = {col: str(map_current_name_to_original_question_fallback.get(col,col))[:256] for col in df_processed.columns}
-                    st.session_state.log_messages.append("--- Fin de Generación de Etiquetas de Variable ---")
+                        local_log.append("Cliente OpenAI no configurado para etiquetas de variable. Usando pregunta original/nombre de columna como fallback.")
+                        spss_variable_labels_dict = {col: str(orig)[:256] for col, orig in map_current_name_to_original_question.items()}
+                    local_log.append("--- Fin de Generación de Etiquetas de Variable ---")
                 else: 
-                    st.session_state.log_messages.append("\nGeneración de etiquetas de variable omitida por el usuario.")
-                    for current_col_name_in_df_proc in df_processed.columns:
-                        original_question = current_col_name_in_df_proc 
-                        for orig_q, simpl_name in original_to_simplified_map_for_labels.items():
-                            if simpl_name == current_col_name_in_df_proc:
-                                original_question = orig_q
-                                break
-                        spss_variable_labels_dict[current_col_name_in_df_proc] = str(original_question)[:256]
+                    local_log.append("\nGeneración de etiquetas de variable omitida por el usuario.")
+                    spss_variable_labels_dict = {col: str(orig)[:256] for col, orig in map_current_name_to_original_question.items()}
 
                 # --- MODIFICADO --- Lógica de codificación para usar la nueva función y flags
                 if do_encode_categorical:
-                    st.session_state.log_messages.append("\n--- Iniciando Codificación de Variables Categóricas ---")
+                    local_log.append("\n--- Iniciando Codificación de Variables Categóricas ---")
                     if openai_client:
                         columnas_a_evaluar = list(df_processed.columns) 
+                        # Conjunto de nombres ocupados: añadir columnas invalida la tabla hash del índice de columnas,
+                        # así que 'in df_processed.columns' la reconstruiría en cada comprobación
+                        nombres_en_uso = set(columnas_a_evaluar)
                         cols_to_encode_spinner = st.empty()
 
+                        sugerencias_llm = {}
+                        if futuro_sugerencias is not None:
+                            cols_to_encode_spinner.info(f"Esperando la codificación sugerida por el LLM para {len(columnas_sin_cache)} conjuntos de categorías...")
+                            sugerencias_llm = futuro_sugerencias.result() or {}
+                            nuevas_codificaciones = {(modelo_codificacion, frozenset(columnas_sin_cache[col])): sugerencia for col, sugerencia in sugerencias_llm.items() if sugerencia}
+                            st.session_state.codificaciones_cache.update(nuevas_codificaciones)
+                            if nuevas_codificaciones:
+                                store_encodings(nuevas_codificaciones)
+
+                        columnas_nuevas = {}
+                        # Una sola barra de progreso, actualizada como mucho ~100 veces, en lugar de un mensaje por columna
+                        cols_to_encode_spinner.empty()
+                        barra_codificacion = st.progress(0.0, text="Aplicando codificación...")
+                        paso_progreso = max(1, len(columnas_a_evaluar) // 100)
                         for i, col_actual_en_df_proc in enumerate(columnas_a_evaluar):
-                            cols_to_encode_spinner.info(f"Evaluando columna para codificación: '{col_actual_en_df_proc}' ({i+1}/{len(columnas_a_evaluar)})")
-                            st.session_state.log_messages.append(f"\nProcesando columna para codificación: '{col_actual_en_df_proc}'")
-
-                            nombre_col_df_original = next((orig for orig, simpl in original_to_simplified_map_for_labels.items() if simpl == col_actual_en_df_proc), col_actual_en_df_proc)
-                            
-                            if nombre_col_df_original not in df_original.columns:
-                                st.session_state.log_messages.append(f"  Advertencia: No se pudo encontrar la columna original para '{col_actual_en_df_proc}'. Omitiendo.")
-                                continue
-                            
-                            if pd.api.types.is_numeric_dtype(df_original[nombre_col_df_original].dtype):
-                                st.session_state.log_messages.append(f"  Omitiendo '{col_actual_en_df_proc}': Ya es de tipo numérico ({df_original[nombre_col_df_original].dtype}).")
-                                continue
-                            
-                            try:
-                                categorias_unicas_series = df_original[nombre_col_df_original].dropna().astype(str).str.strip()
-                                categorias_unicas_series = categorias_unicas_series.replace('', 'nan')
-                                categorias_unicas = sorted(list(categorias_unicas_series.unique()))
-                            except Exception as e:
-                                st.session_state.log_messages.append(f"  Error al obtener categorías únicas de '{nombre_col_df_original}': {e}. Omitiendo.")
-                                continue
-                            
-                            if not categorias_unicas or not (1 < len(categorias_unicas) <= MAX_CATEGORIAS_PARA_LLM):
-                                st.session_state.log_messages.append(f"  Omitiendo '{col_actual_en_df_proc}': {len(categorias_unicas)} categorías (fuera del límite 1-{MAX_CATEGORIAS_PARA_LLM}).")
+                            if i % paso_progreso == 0:
+                                barra_codificacion.progress(i / len(columnas_a_evaluar), text=f"Aplicando codificación ({i+1}/{len(columnas_a_evaluar)})...")
+                            nombre_col_df_original = simplified_to_original.get(col_actual_en_df_proc, col_actual_en_df_proc)
+                            categorias_unicas = columnas_candidatas.get(nombre_col_df_original)
+                            if categorias_unicas is None:
                                 continue
 
-                            clave_cache = tuple(categorias_unicas)
+                            local_log.append(f"\nProcesando columna para codificación: '{col_actual_en_df_proc}'")
+
+                            clave_cache = (modelo_codificacion, frozenset(categorias_unicas))
                             sugerencia = st.session_state.codificaciones_cache.get(clave_cache)
-                            if not sugerencia:
-                                st.session_state.log_messages.append(f"  Consultando LLM para categorías: {clave_cache}.")
-                                with st.spinner(f"Consultando LLM para '{col_actual_en_df_proc}'..."):
-                                     sugerencia = get_llm_categorical_encoding_suggestion(categorias_unicas, client=openai_client)
-                                if sugerencia: st.session_state.codificaciones_cache[clave_cache] = sugerencia
-                            else:
-                                st.session_state.log_messages.append(f"  Usando codificación guardada (caché) para estas categorías.")
+                            if sugerencia and clave_cache not in firmas_consultadas:
+                                local_log.append("  Usando codificación guardada (caché) para estas categorías.")
+                            elif sugerencia is None and use_batch_mode and clave_cache in firmas_consultadas:
+                                local_log.append("  Codificación pendiente del lote enviado a la Batch API; se aplicará al volver a procesar.")
+                                continue
 
                             if sugerencia and sugerencia.get("needs_encoding") and isinstance(sugerencia.get("mapping_dict"), dict):
-                                mapeo_texto_a_numero = {str(k): int(v) for k, v in sugerencia["mapping_dict"].items()}
-                                etiquetas_valor_spss = {int(v): str(k)[:120] for k, v in sugerencia["mapping_dict"].items()}
+                                # Mapeo y etiquetas de valor en una sola pasada sobre la sugerencia
+                                mapeo_texto_a_numero = {}
+                                etiquetas_valor_spss = {}
+                                for k, v in sugerencia["mapping_dict"].items():
+                                    texto, numero = str(k), int(v)
+                                    mapeo_texto_a_numero[texto] = numero
+                                    etiquetas_valor_spss[numero] = texto[:120]
                                 
-                                st.session_state.log_messages.append(f"  Codificación aplicada a '{col_actual_en_df_proc}'. Mapeo: {mapeo_texto_a_numero}")
+                                local_log.append(f"  Codificación aplicada a '{col_actual_en_df_proc}'. Mapeo: {mapeo_texto_a_numero}")
 
-                                source_column_for_mapping = df_original[nombre_col_df_original].astype(str).str.strip().replace('', 'nan')
+                                codificada = map_categories_to_codes(df_original[nombre_col_df_original], mapeo_texto_a_numero)
+                                # Diagnóstico sobre las k categorías (no sobre las filas): las que el mapeo no cubre quedan como NaN
+                                no_mapeadas = [c for c in categorias_unicas if c not in mapeo_texto_a_numero and c != 'nan']
+                                if no_mapeadas:
+                                    local_log.append(f"    Advertencia: {len(no_mapeadas)} categorías de '{nombre_col_df_original}' no se mapearon a números en '{col_actual_en_df_proc}' (quedan como NaN): {no_mapeadas}")
                                 
                                 if encoding_mode == "Crear nuevas columnas (ej. VarName_num)":
                                     columna_destino_spss_name = f"{col_actual_en_df_proc}_num"
                                     # Asegurar unicidad del nuevo nombre de columna
                                     cnt = 1
-                                    while columna_destino_spss_name in df_processed.columns:
+                                    while columna_destino_spss_name in nombres_en_uso:
                                         columna_destino_spss_name = f"{col_actual_en_df_proc}_num{cnt}"
                                         cnt+=1
+                                    nombres_en_uso.add(columna_destino_spss_name)
                                     
-                                    df_processed[columna_destino_spss_name] = source_column_for_mapping.map(mapeo_texto_a_numero)
+                                    columnas_nuevas[columna_destino_spss_name] = codificada
                                     original_var_label = spss_variable_labels_dict.get(col_actual_en_df_proc, col_actual_en_df_proc)
                                     spss_variable_labels_dict[columna_destino_spss_name] = f"{original_var_label} (Codificada)"[:256]
-                                    st.session_state.log_messages.append(f"  Columna '{nombre_col_df_original}' mapeada a NUEVA '{columna_destino_spss_name}'.")
+                                    local_log.append(f"  Columna '{nombre_col_df_original}' mapeada a NUEVA '{columna_destino_spss_name}'.")
                                 else: # Reemplazar
                                     columna_destino_spss_name = col_actual_en_df_proc 
-                                    df_processed[columna_destino_spss_name] = source_column_for_mapping.map(mapeo_texto_a_numero)
-                                    st.session_state.log_messages.append(f"  Valores en '{columna_destino_spss_name}' REEMPLAZADOS con codificación numérica.")
+                                    df_processed[columna_destino_spss_name] = codificada
+                                    local_log.append(f"  Valores en '{columna_destino_spss_name}' REEMPLAZADOS con codificación numérica.")
                                 
                                 spss_value_labels_dict[columna_destino_spss_name] = etiquetas_valor_spss
-                                df_processed[columna_destino_spss_name] = pd.to_numeric(df_processed[columna_destino_spss_name], errors='coerce').astype(pd.Int64Dtype())
                                 
                             else: 
-                                st.session_state.log_messages.append(f"  LLM (o caché) determinó que '{col_actual_en_df_proc}' no requiere codificación especial.")
+                                local_log.append(f"  LLM (o caché) determinó que '{col_actual_en_df_proc}' no requiere codificación especial.")
 
-                        cols_to_encode_spinner.empty()
+                        # Las columnas nuevas se añaden en una sola concatenación en lugar de una inserción por columna
+                        if columnas_nuevas:
+                            df_processed = pd.concat([df_processed, pd.DataFrame(columnas_nuevas, index=df_processed.index)], axis=1)
+                        barra_codificacion.empty()
                     else: 
-                        st.session_state.log_messages.append("Cliente OpenAI no configurado. No se realizará codificación.")
-                    st.session_state.log_messages.append("--- Fin de Codificación Categórica ---")
+                        local_log.append("Cliente OpenAI no configurado. No se realizará codificación.")
+                    local_log.append("--- Fin de Codificación Categórica ---")
                 else:
-                    st.session_state.log_messages.append("\nCodificación categórica omitida por el usuario.")
+                    local_log.append("\nCodificación categórica omitida por el usuario.")
 
 
+                reset_log(local_log)
                 st.session_state.df_processed = df_processed
+                st.session_state.df_version = uuid.uuid4().hex
                 st.session_state.spss_variable_labels = spss_variable_labels_dict
                 st.session_state.spss_value_labels = spss_value_labels_dict
                 
+                # El log se muestra una sola vez, en la sección de descarga, ya con los mensajes de sanitización
                 st.success("🎉 ¡Procesamiento completado!")
-                st.subheader("Log del Proceso")
-                st.text_area("Mensajes:", "\n".join(st.session_state.log_messages), height=300)
 
     except Exception as e:
         st.error(f"Ocurrió un error al cargar o procesar el archivo: {e}")
         st.exception(e)
         st.session_state.df_processed = None
-        st.session_state.log_messages.append(f"ERROR FATAL: {e}")
+        if local_log is not None:
+            reset_log(local_log)
+        extend_log([f"ERROR FATAL: {e}"])
 
 
 # --- Sección de Descarga (sin cambios necesarios en su lógica principal) ---
@@ -567,107 +1299,32 @@ if st.session_state.df_processed is not None:
     st.subheader("Vista Previa del DataFrame Procesado (antes de sanitización final para .sav)")
     st.dataframe(st.session_state.df_processed.head())
 
-    temp_file_path = None
     try:
-        df_to_write = st.session_state.df_processed.copy()
-        
-        sanitization_log_messages = ["\n--- Iniciando Sanitización Final y Preparación para .sav ---"]
-
-        current_col_names_before_final_sanitize = list(df_to_write.columns)
-        final_sav_column_names = []
-        
-        temp_spss_variable_labels = st.session_state.spss_variable_labels.copy()
-        temp_spss_value_labels = st.session_state.spss_value_labels.copy()
-
-        final_spss_variable_labels_for_sav = {}
-        final_spss_value_labels_for_sav = {}
-        
-        seen_final_names = set()
-
-        for col_name_in_df_to_write in current_col_names_before_final_sanitize:
-            base_sanitized_name = sanitize_spss_varname(col_name_in_df_to_write)
-            unique_final_name = base_sanitized_name
-            count = 1
-            while unique_final_name in seen_final_names:
-                prefix = base_sanitized_name[:SPSS_VAR_NAME_MAX_LEN - (len(str(count)) + 1)]
-                unique_final_name = f"{prefix}_{count}"
-                count += 1
-            seen_final_names.add(unique_final_name)
-            final_sav_column_names.append(unique_final_name)
-
-            original_label = temp_spss_variable_labels.get(col_name_in_df_to_write, str(col_name_in_df_to_write)[:256])
-            final_spss_variable_labels_for_sav[unique_final_name] = original_label
-
-            if col_name_in_df_to_write in temp_spss_value_labels:
-                final_spss_value_labels_for_sav[unique_final_name] = temp_spss_value_labels[col_name_in_df_to_write]
-            
-            if col_name_in_df_to_write != unique_final_name:
-                 sanitization_log_messages.append(f"  Nombre de columna final para SPSS: '{col_name_in_df_to_write}' -> '{unique_final_name}'")
-
-        df_to_write.columns = final_sav_column_names 
-        sanitization_log_messages.append("Nombres de columna finales aplicados a df_to_write.")
-        
-        column_labels_list_for_sav = [final_spss_variable_labels_for_sav.get(final_col_name, str(final_col_name)[:256]) for final_col_name in df_to_write.columns]
-        
-        spss_missing_ranges = {}
-        for col in df_to_write.columns:
-            if df_to_write[col].dtype == 'object':
-                try:
-                    numeric_series = pd.to_numeric(df_to_write[col], errors='coerce')
-                    if not numeric_series.isnull().all():
-                        original_values_that_became_nan = df_to_write[col][numeric_series.isnull()]
-                        is_potentially_numeric = all(pd.isna(x) or (isinstance(x, str) and x.lower() in ('nan', '')) for x in original_values_that_became_nan)
-                        
-                        if is_potentially_numeric:
-                            df_to_write[col] = numeric_series
-                            sanitization_log_messages.append(f"  Columna '{col}' convertida a tipo numérico.")
-                        else:
-                            df_to_write[col] = df_to_write[col].astype(str)
-                            spss_missing_ranges[col] = ['nan']
-                            sanitization_log_messages.append(f"  Columna '{col}' tratada como string. Missing range ['nan'] aplicado.")
-                    else:
-                        df_to_write[col] = df_to_write[col].astype(str)
-                        spss_missing_ranges[col] = ['nan']
-                        sanitization_log_messages.append(f"  Columna '{col}' (todo NaN o no numérico) tratada como string. Missing range ['nan'] aplicado.")
-
-                except (ValueError, TypeError): 
-                    df_to_write[col] = df_to_write[col].astype(str)
-                    spss_missing_ranges[col] = ['nan'] 
-                    sanitization_log_messages.append(f"  Columna '{col}' (error en conversión) tratada como string. Missing range ['nan'] aplicado.")
-            
-            elif pd.api.types.is_string_dtype(df_to_write[col].dtype):
-                spss_missing_ranges[col] = ['nan']
-                sanitization_log_messages.append(f"  Columna '{col}' (tipo string) con missing range ['nan'] aplicado.")
-            
-            elif pd.api.types.is_numeric_dtype(df_to_write[col].dtype):
-                 sanitization_log_messages.append(f"  Columna '{col}' es numérica. NaN se tratará como system missing.")
-
-        sanitization_log_messages.append("--- Fin de Sanitización Final y Preparación ---")
-        st.session_state.log_messages.extend(sanitization_log_messages)
+        # La vista previa ya se envió al navegador antes de esta llamada; mientras se escribe el .sav se muestra
+        # un indicador (en los reruns siguientes el resultado sale de la caché y no se ve)
+        with st.spinner("Generando archivo .sav..."):
+            sav_bytes, sanitization_log_messages = build_sav(
+                st.session_state.df_processed,
+                st.session_state.spss_variable_labels,
+                st.session_state.spss_value_labels,
+                compress_sav,
+                st.session_state.df_version,
+            )
+        # Los mensajes de sanitización se añaden al log una vez por resultado, no en cada rerun
+        if st.session_state.sav_log_version != (st.session_state.df_version, compress_sav):
+            extend_log(sanitization_log_messages)
+            st.session_state.sav_log_version = (st.session_state.df_version, compress_sav)
         st.subheader("Log del Proceso (incluye sanitización final)")
-        st.text_area("Mensajes (actualizado con sanitización final):", "\n".join(st.session_state.log_messages), height=200)
+        st.text_area("Mensajes (actualizado con sanitización final):", st.session_state.log_text, height=200)
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".sav") as tmp_file:
-            temp_file_path = tmp_file.name
-        
-        pyreadstat.write_sav(
-            df_to_write, 
-            temp_file_path, 
-            column_labels=column_labels_list_for_sav, 
-            variable_value_labels=final_spss_value_labels_for_sav,
-            missing_ranges=spss_missing_ranges
-        )
-
-        with open(temp_file_path, "rb") as f:
-            sav_bytes = f.read()
-        
-        output_filename_sav = "datos_procesados.sav"
+        extension_salida = ".zsav" if compress_sav else ".sav"
+        output_filename_sav = f"datos_procesados{extension_salida}"
         if uploaded_file:
             base, _ = os.path.splitext(uploaded_file.name)
-            output_filename_sav = f"{base}_procesado.sav"
+            output_filename_sav = f"{base}_procesado{extension_salida}"
 
         st.download_button(
-            label="📥 Descargar Archivo .sav Procesado",
+            label=f"📥 Descargar Archivo {extension_salida} Procesado",
             data=sav_bytes,
             file_name=output_filename_sav,
             mime="application/octet-stream",
@@ -676,14 +1333,9 @@ if st.session_state.df_processed is not None:
     except Exception as e:
         st.error(f"Error al generar el archivo .sav: {e}")
         st.exception(e)
-        st.session_state.log_messages.append(f"ERROR FATAL DURANTE GENERACIÓN .SAV: {e}")
+        extend_log([f"ERROR FATAL DURANTE GENERACIÓN .SAV: {e}"])
         st.subheader("Log del Proceso (con error en .sav)")
-        st.text_area("Mensajes (actualizado con error):", "\n".join(st.session_state.log_messages), height=200)
-
-    finally:
-        if temp_file_path and os.path.exists(temp_file_path):
-            try: os.remove(temp_file_path)
-            except Exception as e_del: st.warning(f"No se pudo eliminar el archivo temporal {temp_file_path}: {e_del}")
+        st.text_area("Mensajes (actualizado con error):", st.session_state.log_text, height=200)
 else:
     if uploaded_file:
         st.info("Haz clic en 'Procesar Datos para .sav' en la barra lateral para comenzar.")
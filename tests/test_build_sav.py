@@ -0,0 +1,33 @@
+import pathlib
+import runpy
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pyreadstat = pytest.importorskip("pyreadstat")
+pytest.importorskip("streamlit")
+
+APP = pathlib.Path(__file__).resolve().parent.parent / "app.py"
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # La caché SQLite del LLM se crea en el directorio de trabajo
+    monkeypatch.chdir(tmp_path)
+    return runpy.run_path(str(APP))
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_build_sav_categorical_text_with_nan(app, tmp_path, compress):
+    # Columna de texto categórica con un valor vacío: pyreadstat exige str de Python, no numpy.str_
+    df = app["load_df"](b"id,Q1\n1,Bueno\n2,\n", "datos.csv")
+    assert isinstance(df["Q1"].dtype, pd.CategoricalDtype)
+
+    sav_bytes, _ = app["build_sav"](df, {}, {}, compress, "v1")
+
+    ruta = tmp_path / ("datos.zsav" if compress else "datos.sav")
+    ruta.write_bytes(sav_bytes)
+    leido, _ = pyreadstat.read_sav(str(ruta))
+    # El vacío se escribe como 'nan', declarado missing de usuario, y se lee de vuelta como NaN
+    assert leido["Q1"].iloc[0] == "Bueno"
+    assert pd.isna(leido["Q1"].iloc[1])